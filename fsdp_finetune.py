@@ -13,17 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
-import gc
+import contextlib
+import functools
+import itertools
 import os
 
 import torch
 from datasets import load_dataset
+from torch.distributed.fsdp import BackwardPrefetch, MixedPrecision, ShardingStrategy
+from torch.distributed.fsdp.wrap import transformer_auto_wrap_policy
 from torch.utils.data import DataLoader
 from transformers import  DataCollatorForLanguageModeling, OPTForCausalLM, AutoTokenizer, get_linear_schedule_with_warmup, set_seed
+from transformers.models.opt.modeling_opt import OPTDecoderLayer
+from transformers.trainer_pt_utils import LengthGroupedSampler
 from utils.save_utils import load_masked_model, load_masked_model_single
-from utils.prehook_utils import put_backward_hooks, remove_all_hooks, check_whitelist
+from utils.prehook_utils import get_weight_masks, apply_weight_masks, get_flat_weight_masks, apply_flat_weight_masks
 
-from accelerate import Accelerator, DistributedType
+from accelerate import Accelerator, DistributedType, FullyShardedDataParallelPlugin
 from tqdm import tqdm
 
 ########################################################################
@@ -57,17 +63,14 @@ def b2mb(x):
 
 # New Code #
 # This context manager is used to track the peak memory usage of the process
+# It only resets the peak gauge, emptying the allocator cache would force a device sync and fresh cudaMallocs
 class TorchTracemalloc:
     def __enter__(self):
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.reset_max_memory_allocated()  # reset the peak gauge to zero
+        torch.cuda.reset_peak_memory_stats()  # reset the peak gauge to zero
         self.begin = torch.cuda.memory_allocated()
         return self
 
     def __exit__(self, *exc):
-        gc.collect()
-        torch.cuda.empty_cache()
         self.end = torch.cuda.memory_allocated()
         self.peak = torch.cuda.max_memory_allocated()
         self.used = b2mb(self.end - self.begin)
@@ -75,6 +78,56 @@ class TorchTracemalloc:
         # print(f"delta used/peak {self.used:4d}/{self.peaked:4d}")
 
 
+# New Code #
+# Wraps a dataloader so the host->device copy of the next batch runs on a separate CUDA stream
+# and overlaps with compute on the current batch (needs pin_memory=True to be truly async)
+class CudaPrefetchLoader:
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device) if device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _copy(self, batch):
+        if self.stream is None:
+            return {k: v.to(self.device) for k, v in batch.items()}, None
+        with torch.cuda.stream(self.stream):
+            batch = {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        return batch, copied
+
+    def _ready(self, batch, copied):
+        if copied is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            # only wait for this batch's copy, not the one just issued for the next batch
+            current_stream.wait_event(copied)
+            # tell the caching allocator these tensors are now used on the compute stream
+            for v in batch.values():
+                v.record_stream(current_stream)
+        return batch
+
+    def __iter__(self):
+        prefetched = None
+        for batch in self.loader:
+            batch = self._copy(batch)
+            if prefetched is not None:
+                yield self._ready(*prefetched)
+            prefetched = batch
+        if prefetched is not None:
+            yield self._ready(*prefetched)
+
+
+# Module level (rather than a closure) so it can be pickled into dataloader worker processes
+def collate_fn(examples, tokenizer, pad_to_max_length=False):
+    # On TPU it's best to pad everything to the same length or training will be very slow.
+    if pad_to_max_length:
+        return tokenizer.pad(examples, padding="max_length", max_length=512, return_tensors="pt")
+    return tokenizer.pad(examples, padding="longest", return_tensors="pt")
+
+
 # For testing only
 if os.environ.get("TESTING_MOCKED_DATALOADERS", None) == "1":
     from accelerate.test_utils.training import mocked_dataloaders
@@ -86,13 +139,35 @@ def training_function(config, args):
     # For testing only
     if os.environ.get("TESTING_MOCKED_DATALOADERS", None) == "1":
         config["num_epochs"] = 2
+    # New Code #
+    # Wrap every decoder layer as its own FSDP unit so the next layer's all-gather can be prefetched
+    # while the current one computes, and allow at most one all-gather in flight to bound peak memory
+    # Setting config['reshard_after_forward'] = False keeps params gathered between forward and backward
+    # (faster, more memory)
+    # With bf16, FSDP also all-gathers params and reduce-scatters grads in bf16, halving communication
+    mixed_precision_policy = None
+    if args.mixed_precision == "bf16":
+        mixed_precision_policy = MixedPrecision(
+            param_dtype=torch.bfloat16, reduce_dtype=torch.bfloat16, buffer_dtype=torch.bfloat16
+        )
+    fsdp_plugin = FullyShardedDataParallelPlugin(
+        sharding_strategy=ShardingStrategy.FULL_SHARD if config.get('reshard_after_forward', True)
+        else ShardingStrategy.SHARD_GRAD_OP,
+        auto_wrap_policy=functools.partial(transformer_auto_wrap_policy, transformer_layer_cls={OPTDecoderLayer}),
+        backward_prefetch=BackwardPrefetch.BACKWARD_PRE,
+        forward_prefetch=True,
+        limit_all_gathers=True,
+        use_orig_params=True,
+        mixed_precision_policy=mixed_precision_policy,
+    )
     # Initialize accelerator
     if args.with_tracking:
         accelerator = Accelerator(
-            cpu=args.cpu, mixed_precision=args.mixed_precision, log_with="wandb", logging_dir=args.logging_dir
+            cpu=args.cpu, mixed_precision=args.mixed_precision, log_with="wandb", logging_dir=args.logging_dir,
+            fsdp_plugin=fsdp_plugin,
         )
     else:
-        accelerator = Accelerator()
+        accelerator = Accelerator(cpu=args.cpu, mixed_precision=args.mixed_precision, fsdp_plugin=fsdp_plugin)
     accelerator.print(accelerator.distributed_type)
 
     if hasattr(args.checkpointing_steps, "isdigit"):
@@ -119,20 +194,29 @@ def training_function(config, args):
 
     tokenizer = AutoTokenizer.from_pretrained(f'facebook/{config["model_name"]}', padding_side='left', model_max_length=512)
     #datasets = load_dataset("glue", "mrpc")
-    datasets = load_dataset('wikitext', 'wikitext-2-raw-v1', streaming=True)
+    # Not streamed: an iterable dataset can't be split across dataloader workers
+    datasets = load_dataset('wikitext', 'wikitext-2-raw-v1')
 
     def tokenize_function(examples):
         # max_length=None => use the model max length (it's actually the default)
-        return tokenizer(examples['text'], truncation=True, padding='max_length')
+        # No padding here, collate_fn pads each batch to its longest example
+        return tokenizer(examples['text'], truncation=True, padding=False, return_overflowing_tokens=False)
 
     # Apply the method we just defined to all the examples in all the splits of the dataset
     # starting with the main process first:
+    # Tokenized once across all cores and cached as Arrow, so later runs and epochs reuse it
     with accelerator.main_process_first():
         tokenized_datasets = datasets.map(
             tokenize_function,
             batched=True,
+            batch_size=1000,
+            num_proc=os.cpu_count(),
             remove_columns=["text"],
         )
+        # Blank wikitext lines are only the BOS token, which leaves nothing to predict (nan loss) without padding
+        tokenized_datasets = tokenized_datasets.filter(
+            lambda example: len(example['input_ids']) > 1, num_proc=os.cpu_count()
+        )
 
     # We also rename the 'label' column to 'labels' which is the expected name for labels by the models of the
     # transformers library
@@ -144,51 +228,91 @@ def training_function(config, args):
         gradient_accumulation_steps = batch_size // MAX_GPU_BATCH_SIZE
         batch_size = MAX_GPU_BATCH_SIZE
 
-    def collate_fn(examples):
-        # On TPU it's best to pad everything to the same length or training will be very slow.
-        if accelerator.distributed_type == DistributedType.TPU:
-            return tokenizer.pad(examples, padding="max_length", max_length=512, return_tensors="pt")
-        return tokenizer.pad(examples, padding="longest", return_tensors="pt")
-
     # Instantiate dataloaders.
+    # Tokenization/collation runs in worker processes and batches are pinned, so the GPU isn't left waiting on the host
+    num_workers = max(min((os.cpu_count() or 1) - 2, 8), 0)
+    worker_kwargs = {"persistent_workers": True, "prefetch_factor": 4} if num_workers > 0 else {}
+    # Group examples of similar length into the same batch so padding="longest" pads as little as possible
+    train_sampler = LengthGroupedSampler(
+        batch_size, lengths=[len(ids) for ids in tokenized_datasets["train"]["input_ids"]]
+    )
     train_dataloader = DataLoader(
-        tokenized_datasets["train"].with_format("torch"), collate_fn=collate_fn, batch_size=batch_size
+        tokenized_datasets["train"].with_format("torch"),
+        sampler=train_sampler,
+        collate_fn=functools.partial(
+            collate_fn, tokenizer=tokenizer, pad_to_max_length=accelerator.distributed_type == DistributedType.TPU
+        ),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+        **worker_kwargs,
     )
 
     set_seed(seed)
 
     # Instantiate the model (we build the model here so that the seed also control new weights initialization)
     #model = AutoModelForSequenceClassification.from_pretrained(args.model_name_or_path, return_dict=True)
+    # Attention maps and hidden states aren't used in training, returning them keeps every layer's copy alive
+    # and blocks torch.compile fusions, the KV cache is only useful for generation
+    # Attention runs through PyTorch's fused SDPA kernel instead of materializing the L x L matrix,
+    # config['attn_implementation'] = "flash_attention_2" can be used if flash-attn is installed
     if not config.get('model'):
         model = OPTForCausalLM.from_pretrained(f'facebook/{config["model_name"]}',
-                                                          output_attentions=True,
-                                                          output_hidden_states=True)
+                                                          output_attentions=False,
+                                                          output_hidden_states=False,
+                                                          use_cache=False,
+                                                          attn_implementation=config.get('attn_implementation', 'sdpa'))
 
         load_masked_model_single(model, f'pruned_models/{config["model_name"]}-{config["sparsity"]}.pt')
     else:
         model = config.get('model')
+        # The caller's model keeps being used after training, so its config is put back at the end
+        caller_config = model.config
+        caller_flags = {key: getattr(caller_config, key)
+                        for key in ('output_attentions', 'output_hidden_states', 'use_cache')}
+        caller_config.update(dict.fromkeys(caller_flags, False))
 
 
-    # back_hooks = put_backward_hooks(model=model)
-
-    for name, param in model.named_parameters():
-        if 'weight' in name and check_whitelist(name):
-            mask = param != 0
-            print(f"prop nonzeros: {torch.sum(mask) / torch.numel(param)}")
-            def hook(grad, mask=mask):
-                return grad * mask.float()
-            param.register_hook(hook)
-
     # New Code #
     # For FSDP feature, it is highly recommended and efficient to prepare the model before creating optimizer
     model = accelerator.prepare(model)
     #accelerator.print(model)
 
+    # Masks are built after prepare so they match the (possibly sharded) parameters,
+    # pruned weights are re-zeroed after every optimizer step instead of masking gradients with hooks
+    layer_nonzero_counts = {}
+    masks = get_weight_masks(model, nonzero_counts=layer_nonzero_counts)
+    # Each rank only counts its own shards, so the counts and sizes are summed across ranks
+    # and copied to the host in one go, rather than a sync + print per layer
+    if layer_nonzero_counts:
+        counts = torch.stack([count for count, _ in layer_nonzero_counts.values()])
+        numels = torch.tensor([numel for _, numel in layer_nonzero_counts.values()], device=counts.device)
+        counts, numels = accelerator.reduce(torch.stack((counts, numels)), reduction="sum").cpu()
+        prop_nonzeros = counts / numels
+        if config.get('verbose'):
+            for name, prop in zip(layer_nonzero_counts, prop_nonzeros.tolist()):
+                accelerator.print(f"{name} prop nonzeros: {prop}")
+        quartiles = torch.quantile(prop_nonzeros, torch.tensor([0.25, 0.5, 0.75])).tolist()
+        accelerator.print(f"prop nonzeros: mean {prop_nonzeros.mean().item()}, quartiles {quartiles}")
+    # Under FSDP, masks are merged per flat parameter (one multiply per decoder layer),
+    # anything not inside a flat parameter keeps its own mask
+    flat_masks, masks = get_flat_weight_masks(model, masks)
+
+    # Compiled (needs use_orig_params=True under FSDP) for the forward/backward pass only,
+    # masking, gradient sync and saving keep using `model` so parameter names stay unprefixed
+    # Default mode rather than max-autotune: its CUDA graphs would record a new graph (and memory pool) per batch shape
+    # Set config['compile'] = False to skip compilation (here and in the post-step masking), e.g. for very short runs
+    use_compile = config.get('compile', True)
+    forward_model = torch.compile(model) if use_compile else model
+
     # Instantiate optimizer
     # New Code #
     # For FSDP feature, at present it doesn't support multiple parameter groups,
     # so we need to create a single parameter group for the whole model
-    optimizer = torch.optim.AdamW(params=model.parameters(), lr=lr, weight_decay=2e-4)
+    # The fused CUDA kernel updates every parameter in one launch (needs use_orig_params=True under FSDP, set above)
+    optimizer = torch.optim.AdamW(
+        params=model.parameters(), lr=lr, weight_decay=2e-4, fused=accelerator.device.type == "cuda"
+    )
 
     # Instantiate scheduler
     lr_scheduler = get_linear_schedule_with_warmup(
@@ -202,8 +326,10 @@ def training_function(config, args):
     # before creating the optimizer
     # There is no specific order to remember, we just need to unpack the objects in the same order we gave them to the
     # prepare method.
-    optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
-        optimizer, train_dataloader, lr_scheduler
+    # The dataloader is prepared without device placement, CudaPrefetchLoader copies batches to the GPU on a side stream
+    optimizer, lr_scheduler = accelerator.prepare(optimizer, lr_scheduler)
+    train_dataloader = CudaPrefetchLoader(
+        accelerator.prepare_data_loader(train_dataloader, device_placement=False), accelerator.device
     )
 
     overall_step = 0
@@ -234,33 +360,42 @@ def training_function(config, args):
     # Now we train the model
     for epoch in tqdm(range(num_epochs)):
         # New Code #
-        # context manager to track the peak memory usage during the training epoch
-        with TorchTracemalloc() as tracemalloc:
+        # context manager to track the peak memory usage during the training epoch (only when tracking)
+        with TorchTracemalloc() if args.with_tracking else contextlib.nullcontext() as tracemalloc:
             model.train()
             if args.with_tracking:
                 total_loss = 0
-            for step, batch in enumerate(train_dataloader):
-                if step == config['max_step']:
-                    break
+            num_steps = min(config['max_step'], len(train_dataloader))
+            for step, batch in enumerate(itertools.islice(train_dataloader, num_steps)):
                 # We need to skip steps until we reach the resumed step
                 if args.resume_from_checkpoint and epoch == 0:
                     if resume_step is not None and step < resume_step:
                         pass
-                # We could avoid this line since we set the accelerator with `device_placement=True`.
-                batch.to(accelerator.device)
-                outputs = model(**batch, labels=batch['input_ids'])
-                # print(f"max memory: {torch.cuda.memory_allocated()}")
-                loss = outputs.loss
-                #print(f'Loss: {loss}')
-                loss = loss / gradient_accumulation_steps
-                # We keep track of the loss at each epoch
-                if args.with_tracking:
-                    total_loss += loss.detach().float()
-                accelerator.backward(loss)
-                if step % gradient_accumulation_steps == 0:
+                # Gradients are only reduce-scattered on the last microbatch of each accumulation window
+                # (or of the epoch), the others accumulate locally under FSDP's no_sync
+                is_last_microbatch = (step + 1) % gradient_accumulation_steps == 0 or step + 1 == num_steps
+                # The epoch's last window can be shorter than gradient_accumulation_steps, average over its real size
+                window_start = step - step % gradient_accumulation_steps
+                window_size = min(gradient_accumulation_steps, num_steps - window_start)
+                with contextlib.nullcontext() if is_last_microbatch else accelerator.no_sync(model):
+                    # labels alias input_ids on the device (no clone), the model does the shift-by-one itself
+                    # Adding labels in collate_fn instead would get pinned and copied to the GPU a second time,
+                    # and input_ids stay int64 since cross_entropy needs int64 targets
+                    outputs = forward_model(**batch, labels=batch['input_ids'])
+                    # print(f"max memory: {torch.cuda.memory_allocated()}")
+                    loss = outputs.loss
+                    #print(f'Loss: {loss}')
+                    loss = loss / window_size
+                    # We keep track of the loss at each epoch
+                    if args.with_tracking:
+                        total_loss += loss.detach().float()
+                    accelerator.backward(loss)
+                if is_last_microbatch:
                     optimizer.step()
+                    apply_flat_weight_masks(flat_masks, compile=use_compile)
+                    apply_weight_masks(model, masks, compile=use_compile)
                     lr_scheduler.step()
-                    optimizer.zero_grad()
+                    optimizer.zero_grad(set_to_none=True)
                     # accelerator.print(lr_scheduler.get_lr())
 
                 overall_step += 1
@@ -273,27 +408,39 @@ def training_function(config, args):
                         accelerator.save_state(output_dir)
         # New Code #
         # Printing the GPU memory usage details such as allocated memory, peak memory, and total memory usage
-        accelerator.print("Memory before entering the train : {}".format(b2mb(tracemalloc.begin)))
-        accelerator.print("Memory consumed at the end of the train (end-begin): {}".format(tracemalloc.used))
-        accelerator.print("Peak Memory consumed during the train (max-begin): {}".format(tracemalloc.peaked))
-        accelerator.print(
-            "Total Peak Memory consumed during the train (max): {}".format(
-                tracemalloc.peaked + b2mb(tracemalloc.begin)
-            )
-        )
-        # Logging the peak memory usage of the GPU to the tracker
         if args.with_tracking:
+            accelerator.print("Memory before entering the train : {}".format(b2mb(tracemalloc.begin)))
+            accelerator.print("Memory consumed at the end of the train (end-begin): {}".format(tracemalloc.used))
+            accelerator.print("Peak Memory consumed during the train (max-begin): {}".format(tracemalloc.peaked))
+            accelerator.print(
+                "Total Peak Memory consumed during the train (max): {}".format(
+                    tracemalloc.peaked + b2mb(tracemalloc.begin)
+                )
+            )
+            # Logging the peak memory usage of the GPU to the tracker
             accelerator.log(
                 {
                     "train_total_peak_memory": tracemalloc.peaked + b2mb(tracemalloc.begin),
                 },
                 step=epoch,
-        )
-    remove_all_hooks(model)
+            )
     torch.cuda.empty_cache()
 
-    if not config.get('save_model') or config['save_model']:
-        torch.save(model, f'pruned_models/{config["model_name"]}-{config["sparsity"]}-finetuned.pt')
+    if config.get('save_model', True):
+        # Save a state dict rather than pickling the FSDP-wrapped module, accelerate gathers the full
+        # state dict onto rank 0 (offloaded to CPU)
+        accelerator.wait_for_everyone()
+        state_dict = accelerator.get_state_dict(model)
+        if accelerator.is_main_process:
+            # Strip the prune reparametrization so the file has plain `weight` keys like the other finetuned
+            # checkpoints (weight_orig is already 0 wherever it's pruned), prune.remove would break FSDP's flat param views
+            state_dict = {(k[:-len('_orig')] if k.endswith('.weight_orig') else k): v
+                          for k, v in state_dict.items() if not k.endswith('.weight_mask')}
+            torch.save(state_dict, f'pruned_models/{config["model_name"]}-{config["sparsity"]}-finetuned.pt',
+                       pickle_protocol=5)
+
+    if config.get('model'):
+        caller_config.update(caller_flags)
 
 
 def fsdp_finetune(config):
@@ -338,5 +485,7 @@ def fsdp_finetune(config):
         help="Location on where to store experiment tracking logs`",
     )
     #args = parser.parse_args()
-    args = parser.parse_args(['--mixed_precision', 'fp16'])
+    # bf16 needs Ampere or newer, older GPUs (V100, T4) fall back to fp16
+    mixed_precision = 'fp16' if torch.cuda.is_available() and not torch.cuda.is_bf16_supported() else 'bf16'
+    args = parser.parse_args(['--mixed_precision', mixed_precision])
     training_function(config, args)
\ No newline at end of file
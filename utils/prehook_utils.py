@@ -1,4 +1,5 @@
 import torch
+from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
 from utils.hessian_utils import calc_hessian
 from collections import OrderedDict
 from typing import Dict, Callable
@@ -137,6 +138,113 @@ def put_backward_hooks(model, whitelist=opt_whitelist):#, storage_dir, offload_f
 
     return all_hooks
 
+# Bit positions used by the packed masks, built once per device rather than on every call
+mask_shifts = {}
+def get_mask_shifts(device):
+    if device not in mask_shifts:
+        mask_shifts[device] = torch.arange(8, dtype=torch.uint8, device=device)
+    return mask_shifts[device]
+
+# Pack a bool mask into a flat uint8 bitmap, 8 weights per byte (8x smaller than a bool mask)
+def pack_mask(mask):
+    flat = mask.reshape(-1)
+    pad = (-flat.numel()) % 8
+    if pad:
+        flat = torch.cat((flat, flat.new_zeros(pad)))
+    return (flat.view(-1, 8).to(torch.uint8) << get_mask_shifts(mask.device)).sum(dim=-1).to(torch.uint8)
+
+# Unpack a bitmap from pack_mask back into a bool mask shaped like param
+def unpack_mask(packed, param):
+    mask = ((packed.unsqueeze(-1) >> get_mask_shifts(packed.device)) & 1).view(-1)[:param.numel()]
+    return mask.bool().view(param.shape)
+
+# Unpack and multiply in one go, compiled into a single fused kernel by mask_tensor_
+def unpack_mul_(tensor, packed, shifts):
+    mask = ((packed.unsqueeze(-1) >> shifts) & 1).view(-1)[:tensor.numel()]
+    tensor.mul_(mask.view(tensor.shape))
+
+# Compiled unpack_mul_, only built on first use so importing this module never pulls in Inductor
+compiled_unpack_mul = []
+def get_compiled_unpack_mul():
+    if not compiled_unpack_mul:
+        compiled_unpack_mul.append(torch.compile(unpack_mul_, dynamic=True))
+    return compiled_unpack_mul[0]
+
+# Zero the pruned entries of tensor in place, given its packed mask
+# With compile=True no layer-sized mask temporaries are made every step, otherwise the mask is unpacked eagerly
+def mask_tensor_(tensor, packed, compile=False):
+    if compile:
+        # .data so the compiled helper sees a plain tensor rather than an (FSDP flat) Parameter
+        get_compiled_unpack_mul()(tensor.data, packed, get_mask_shifts(packed.device))
+    else:
+        tensor.mul_(unpack_mask(packed, tensor))
+
+# Collect masks of the nonzero (unpruned) weights, keyed by parameter name, packed with pack_mask
+# Build these after the model is wrapped (e.g. by FSDP) so each mask lives on the same device/shard as its parameter
+# Weights under the prune reparametrization (mask_from_pruned) already have their mask in a weight_mask buffer,
+# that buffer is read instead of rescanning the weight whenever the parameter still holds the whole tensor
+# (not split across FSDP ranks)
+# If a nonzero_counts dict is passed, it is filled with (number of unpruned weights as a device tensor, numel)
+# per parameter, counting only the local shard, with an entry for every masked parameter even where the shard is empty
+def get_weight_masks(model, whitelist=opt_whitelist, nonzero_counts=None):
+    masks = {}
+    buffers = dict(model.named_buffers())
+    for n, p in model.named_parameters():
+        if check_whitelist(n, whitelist=whitelist) and "weight" in n:
+            prune_mask = buffers.get(n[:-len('_orig')] + '_mask') if n.endswith('_orig') else None
+            if prune_mask is not None and prune_mask.numel() == p.numel():
+                mask = prune_mask.view(p.shape).bool()
+            else:
+                mask = (p != 0)
+            if nonzero_counts is not None:
+                nonzero_counts[n] = (mask.sum(), mask.numel())
+            masks[n] = pack_mask(mask)
+
+    return masks
+
+# Merge per-parameter masks into one mask per FSDP flat parameter, so the post-step masking is a single
+# multiply per FSDP unit instead of one per weight
+# Needs use_orig_params=True, where each original parameter is a view into its unit's (sharded) flat parameter
+# Returns a list of (flat parameter, mask) pairs and the masks of parameters that aren't inside any flat parameter
+def get_flat_weight_masks(model, masks):
+    remaining = {n: p for n, p in model.named_parameters() if n in masks}
+    flat_masks = []
+    # One unit at a time, so only a single unit's dense mask exists before it is packed
+    for m in FSDP.fsdp_modules(model):
+        flat = getattr(m, '_flat_param', None)
+        if flat is None:
+            continue
+        dense = None
+        for n, p in list(remaining.items()):
+            offset = (p.data_ptr() - flat.data_ptr()) // p.element_size()
+            if p.numel() > 0 and p.dtype == flat.dtype and 0 <= offset and offset + p.numel() <= flat.numel():
+                if dense is None:
+                    dense = torch.ones(flat.numel(), dtype=torch.bool, device=flat.device)
+                dense[offset:offset + p.numel()] = unpack_mask(masks[n], p).view(-1)
+                del remaining[n]
+        if dense is not None:
+            flat_masks.append((flat, pack_mask(dense)))
+            del dense
+
+    return flat_masks, {n: masks[n] for n in remaining}
+
+# Re-zero pruned weights of each FSDP flat parameter in place (see get_flat_weight_masks)
+@torch.no_grad()
+def apply_flat_weight_masks(flat_masks, compile=False):
+    for flat, mask in flat_masks:
+        mask_tensor_(flat, mask, compile=compile)
+
+# Re-zero pruned weights in place, replaces per-parameter gradient hooks
+# Call right after optimizer.step() so pruned weights never drift away from 0
+@torch.no_grad()
+def apply_weight_masks(model, masks, compile=False):
+    if not masks:
+        return
+    for n, p in model.named_parameters():
+        mask = masks.get(n)
+        if mask is not None:
+            mask_tensor_(p, mask, compile=compile)
+
 def remove_all_hooks(model: torch.nn.Module) -> None:
     for name, child in model._modules.items():
         if child is not None: